@@ -1,143 +1,162 @@
 #!/usr/bin/env python3
 import argparse
+import collections
+import concurrent.futures
 import dataclasses
+import functools
 import logging
 import os
 import pathlib
+import queue
+import shlex
+import shutil
 import subprocess
 import sys
+import tempfile
 import typing
 
 logger = logging.getLogger(__name__)
 
+# Resolve the executables once instead of searching PATH for each of the many calls.
+_DOCKER = shutil.which("docker") or "docker"
+_RSYNC = shutil.which("rsync") or "rsync"
+_SSH = shutil.which("ssh") or "ssh"
+
 MACHINE_SETS = {
     "single": ["bsbt1"],  # This is how it is saved in my ssh_config
 }
 
-PARSER = argparse.ArgumentParser(
-    description=" ".join(
-        [
-            "Build and update packages.",
-            "Build packages for each FOLDER, copy them over to the given MACHINES and update them.",
-            "Package buildings is done via Docker.",
-            "Note that packages are only updated, i.e. if they are not installed the package will not",
-            "be installed on the target machine.",
-            'You can skip the check if the package is installed using "-c".',
-            "The script is supposed to run anywhere in a git repository",
-            "and FOLDER has to be relative to the root of the repo.",
-        ]
-    ),
-    epilog="\n".join(
-        [
-            "These are the configured predefined sets of machines:",
-        ]
-        + [f'{key}: {",".join(machines)}' for key, machines in MACHINE_SETS.items()]
-    ),
-    formatter_class=argparse.RawDescriptionHelpFormatter,
-)
-PARSER.add_argument(
-    "folders",
-    metavar="FOLDER",
-    nargs="+",
-    help=" ".join(
-        [
-            'The name of the folders to build (or -if "-b" is given- search) packages for.',
-            "You have to pass in the relative name from the repository root",
-            "Note that more than one package can stem from the same folder.",
-        ]
-    ),
-)
-PARSER.add_argument(
-    "-m",
-    "--machines",
-    default=os.environ.get("UP_MACHINES"),
-    help=" ".join(
-        [
-            "The set of machines to update the packages on.",
-            "This has to be a comma separated list.",
-            'You can also set this argument via the "UP_MACHINES" environment variable.',
-        ]
-    ),
-)
-PARSER.add_argument(
-    "--ssh-config",
-    default=os.environ.get("UP_SSH_CONFIG"),
-    help=" ".join(
-        [
-            "A ssh configuration file to pass on to ssh via the '-F' option.",
-            'You can also set this argument via the "UP_SSH_CONFIG" environment variable.',
-        ]
-    ),
-)
-PARSER.add_argument(
-    "-i",
-    "--docker-image",
-    metavar="IMG",
-    default=os.environ.get("UP_DOCKER_IMAGE"),
-    help=" ".join(
-        [
-            "Use IMG to build packages.",
-            'You can also set this argument via the "UP_DOCKER_IMAGE" environment variable.',
-        ]
-    ),
-)
-PARSER.add_argument(
-    "-p",
-    "--prefix",
-    default="",
-    help=" ".join(
-        [
-            "Prefix all machines with the given string.",
-            "Empty by default.",
-        ]
-    ),
-)
-PARSER.add_argument(
-    "--repository-root",
-    help=" ".join(
-        [
-            "The root of the repository. By default the root is searched by walking up",
-            "the filetree until the `.git' directory is found.",
-        ]
-    ),
-)
-PARSER.add_argument(
-    "-b",
-    "--skip-package-build",
-    help=" ".join(
-        [
-            "Skip the build of the package before distributing it. Note that this results in a",
-            "slightly different behaviour: the `FOLDER's are now simply searched for `.deb' files",
-            "which are then assumed to be distributed. Make sure to clean up built packages!.",
-        ]
-    ),
-    action="store_true",
-)
-PARSER.add_argument(
-    "-c",
-    "--skip-install-check",
-    help="Skip the check if the package is installed on the machines.",
-    action="store_true",
-)
-PARSER.add_argument(
-    "-l",
-    "--log-level",
-    default=logging.INFO,
-    help=" ".join(
-        [
-            "Set the levels of logging which should get printed to stdout. The lower the more",
-            "messages you will see. Default: %(default)s.",
-        ]
-    ),
-    choices=[
-        logging.DEBUG,
-        logging.INFO,
-        logging.WARNING,
-        logging.ERROR,
-        logging.CRITICAL,
-    ],
-    type=int,
-)
+
+def make_arg_parser() -> argparse.ArgumentParser:
+    parser = argparse.ArgumentParser(
+        description=" ".join(
+            [
+                "Build and update packages.",
+                "Build packages for each FOLDER, copy them over to the given MACHINES and update them.",
+                "Package buildings is done via Docker.",
+                "Note that packages are only updated, i.e. if they are not installed the package will not",
+                "be installed on the target machine.",
+                'You can skip the check if the package is installed using "-c".',
+                "The script is supposed to run anywhere in a git repository",
+                "and FOLDER has to be relative to the root of the repo.",
+            ]
+        ),
+        epilog="\n".join(
+            [
+                "These are the configured predefined sets of machines:",
+            ]
+            + [f'{key}: {",".join(machines)}' for key, machines in MACHINE_SETS.items()]
+        ),
+        formatter_class=argparse.RawDescriptionHelpFormatter,
+    )
+    parser.add_argument(
+        "folders",
+        metavar="FOLDER",
+        nargs="+",
+        help=" ".join(
+            [
+                'The name of the folders to build (or -if "-b" is given- search) packages for.',
+                "You have to pass in the relative name from the repository root",
+                "Note that more than one package can stem from the same folder.",
+            ]
+        ),
+    )
+    parser.add_argument(
+        "-m",
+        "--machines",
+        default=os.environ.get("UP_MACHINES"),
+        help=" ".join(
+            [
+                "The set of machines to update the packages on.",
+                "This has to be a comma separated list.",
+                'You can also set this argument via the "UP_MACHINES" environment variable.',
+            ]
+        ),
+    )
+    parser.add_argument(
+        "--ssh-config",
+        default=os.environ.get("UP_SSH_CONFIG"),
+        help=" ".join(
+            [
+                "A ssh configuration file to pass on to ssh via the '-F' option.",
+                'You can also set this argument via the "UP_SSH_CONFIG" environment variable.',
+            ]
+        ),
+    )
+    parser.add_argument(
+        "-i",
+        "--docker-image",
+        metavar="IMG",
+        default=os.environ.get("UP_DOCKER_IMAGE"),
+        help=" ".join(
+            [
+                "Use IMG to build packages.",
+                'You can also set this argument via the "UP_DOCKER_IMAGE" environment variable.',
+            ]
+        ),
+    )
+    parser.add_argument(
+        "-p",
+        "--prefix",
+        default="",
+        help=" ".join(
+            [
+                "Prefix all machines with the given string.",
+                "Empty by default.",
+            ]
+        ),
+    )
+    parser.add_argument(
+        "--repository-root",
+        help=" ".join(
+            [
+                "The root of the repository. By default the root is searched by walking up",
+                "the filetree until the `.git' directory is found.",
+            ]
+        ),
+    )
+    parser.add_argument(
+        "-b",
+        "--skip-package-build",
+        help=" ".join(
+            [
+                "Skip the build of the package before distributing it. Note that this results in a",
+                "slightly different behaviour: the `FOLDER's are now simply searched for `.deb' files",
+                "which are then assumed to be distributed. Make sure to clean up built packages!.",
+            ]
+        ),
+        action="store_true",
+    )
+    parser.add_argument(
+        "-c",
+        "--skip-install-check",
+        help="Skip the check if the package is installed on the machines.",
+        action="store_true",
+    )
+    parser.add_argument(
+        "-l",
+        "--log-level",
+        default=logging.INFO,
+        help=" ".join(
+            [
+                "Set the levels of logging which should get printed to stdout. The lower the more",
+                "messages you will see. Default: %(default)s.",
+            ]
+        ),
+        choices=[
+            logging.DEBUG,
+            logging.INFO,
+            logging.WARNING,
+            logging.ERROR,
+            logging.CRITICAL,
+        ],
+        type=int,
+    )
+    return parser
+
+
+# Maps directories to the repository root they belong to.
+_REPO_ROOT_CACHE: typing.Dict[pathlib.Path, pathlib.Path] = {}
 
 
 class Configuration(typing.NamedTuple):
@@ -149,7 +168,7 @@ class Configuration(typing.NamedTuple):
 
     repository_root: pathlib.Path
     # The branch_name is not used here, but was of use in other scripts. So I'll leave it here for
-    # convenience.
+    # convenience. It is left empty to not run git on every invocation, though.
     branch_name: str
     machines: typing.List[str]
     ssh_config: str
@@ -165,12 +184,6 @@ class Configuration(typing.NamedTuple):
             repo_root = pathlib.Path(args.repository_root).resolve()
         else:
             repo_root = cls.search_repository_root(pathlib.Path(".").resolve())
-        git_rev_parse = subprocess.run(
-            ["git", "-C", repo_root, "rev-parse", "--abbrev-ref", "HEAD"],
-            check=True,
-            stdout=subprocess.PIPE,
-        )
-        branch_name = git_rev_parse.stdout.decode().strip()
         if args.machines is None:
             logger.error('No MACHINES provdided. See the "--machines" option.')
             sys.exit(1)
@@ -181,9 +194,13 @@ class Configuration(typing.NamedTuple):
         if args.docker_image is None:
             logger.error('No Docker image provided. See the "--docker-image" option.')
             sys.exit(1)
+        for folder in args.folders:
+            if not (repo_root / folder).is_dir():
+                logger.error(f'FOLDER "{folder}" is not a directory in {repo_root}.')
+                sys.exit(1)
         return cls(
             repository_root=repo_root,
-            branch_name=branch_name,
+            branch_name="",
             machines=machines,
             ssh_config=args.ssh_config,
             docker_image=args.docker_image,
@@ -194,34 +211,104 @@ class Configuration(typing.NamedTuple):
 
     @classmethod
     def search_repository_root(cls, current: pathlib.Path) -> pathlib.Path:
-        if (current / ".git").exists():
-            return current
-        if current.parent == current:
-            raise Exception("Could not find repository root!")
-        return cls.search_repository_root(current.parent)
+        if current in _REPO_ROOT_CACHE:
+            return _REPO_ROOT_CACHE[current]
+        root = current
+        while not (root / ".git").exists():
+            if root.parent == root:
+                raise Exception("Could not find repository root!")
+            root = root.parent
+        for ancestor in [current, *current.parents]:
+            _REPO_ROOT_CACHE[ancestor] = root
+            if ancestor == root:
+                break
+        return root
 
 
 def main(args: argparse.Namespace):
     cfg = Configuration.from_args(args)
     logger.info(f"Configuration is:\n{cfg}")
-    pkg_files = build_packages_and_get_paths(cfg)
-    update_packages(cfg, pkg_files)
+    update_packages(cfg)
 
 
-def build_packages_and_get_paths(cfg: Configuration) -> typing.List[pathlib.Path]:
+def build_packages_and_get_paths(
+    cfg: Configuration,
+    on_package: typing.Optional[typing.Callable[[pathlib.Path], None]] = None,
+) -> typing.List[pathlib.Path]:
+    """Build the packages of all folders and return the paths of the package files.
+
+    If given, `on_package' is called with the path of each package as soon as it is available,
+    i.e. possibly while other packages are still building.
+
+    """
     result = []
-    for directory in cfg.folders:
-        dir_abs = cfg.repository_root / directory
-        if cfg.skip_build:
-            for pkg_file in dir_abs.glob("*.deb"):
-                result.append(pkg_file)
-        else:
-            proc = build_packages(cfg, directory)
-            for pkg_file in get_package_from_stdout(proc):
-                result.append(dir_abs / pkg_file)
+    # Docker needs absolute paths for the volume, so resolve the folders once up front.
+    dir_abs_map = {
+        directory: (cfg.repository_root / directory).resolve()
+        for directory in cfg.folders
+    }
+    if cfg.skip_build:
+        for directory in cfg.folders:
+            with os.scandir(dir_abs_map[directory]) as entries:
+                for entry in entries:
+                    if entry.is_file() and entry.name.endswith(".deb"):
+                        pkg_path = pathlib.Path(entry.path)
+                        if on_package is not None:
+                            on_package(pkg_path)
+                        result.append(pkg_path)
+        return result
+
+    pull_docker_image_if_needed(cfg)
+    # The builds of the folders are independent of each other, so run them concurrently. Each
+    # build is heavy on its own, hence only use half of the CPUs.
+    max_workers = (os.cpu_count() or 2) // 2 or 1
+    with concurrent.futures.ThreadPoolExecutor(max_workers=max_workers) as executor:
+        futures = [
+            executor.submit(
+                _build_and_get_paths, cfg, directory, dir_abs_map[directory], on_package
+            )
+            for directory in cfg.folders
+        ]
+        for future in futures:
+            result.extend(future.result())
     return result
 
 
+def pull_docker_image_if_needed(cfg: Configuration) -> None:
+    # Pull once up front, otherwise each of the concurrent builds would pull the image itself.
+    inspect = subprocess.run(
+        [_DOCKER, "image", "inspect", cfg.docker_image],
+        stdout=subprocess.DEVNULL,
+        stderr=subprocess.DEVNULL,
+    )
+    if inspect.returncode != 0:
+        logger.info(f"Pulling Docker image {cfg.docker_image}")
+        subprocess.run([_DOCKER, "pull", cfg.docker_image], check=True)
+
+
+def _build_and_get_paths(
+    cfg: Configuration,
+    directory: str,
+    dir_abs: pathlib.Path,
+    on_package: typing.Optional[typing.Callable[[pathlib.Path], None]],
+) -> typing.List[pathlib.Path]:
+    result = []
+    lines = build_packages(cfg, directory, dir_abs)
+    for pkg_file in get_package_from_stdout(lines):
+        pkg_path = dir_abs / pkg_file
+        if on_package is not None:
+            on_package(pkg_path)
+        result.append(pkg_path)
+    return result
+
+
+# The build script announces each built package with a line starting with this prefix.
+_PKG_PREFIX = "PKG_FILE="
+_PKG_PREFIX_LEN = len(_PKG_PREFIX)
+
+# Number of lines of the build output to log if the build fails.
+_BUILD_LOG_TAIL = 200
+
 _BUILD_SCRIPT = """
 #!/bin/bash
 set -ex
@@ -250,116 +337,323 @@ done
 """
 
 
-def build_packages(cfg: Configuration, directory: str) -> subprocess.CompletedProcess:
+def build_packages(
+    cfg: Configuration, directory: str, dir_abs: pathlib.Path
+) -> typing.Iterator[str]:
     logger.info(f"Building packages in {directory}")
     cmd = [
-        "docker",
+        _DOCKER,
         "run",
         "--rm",
-        "-it",
         # Eventually we need sys_admin to do fancy things in the Docker container, like chrooting
         #'--cap-add=sys_admin',
-        f"--volume={cfg.repository_root / directory}:/source",
+        f"--volume={dir_abs}:/source",
         "--workdir=/source",
         cfg.docker_image,
         f"/bin/bash",
         "-c",
         _BUILD_SCRIPT,
     ]
-    proc = None
     logger.debug(f"Command is:\n%s", " ".join(cmd))
-    try:
-        proc = subprocess.run(
-            cmd, check=True, stdout=subprocess.PIPE, stderr=subprocess.STDOUT
-        )
-    except subprocess.CalledProcessError as proc:
-        logger.error(proc.stdout.decode())
-        raise
-    logger.debug(f"Output is:\n{proc.stdout.decode()}")
-    return proc
-
-
-def get_package_from_stdout(proc: subprocess.CompletedProcess) -> typing.Iterable[str]:
-    for line in proc.stdout.decode().splitlines():
-        if line.startswith("PKG_FILE="):
-            pkg_file = line[len("PKG_FILE=") :]
+    # Only keep the tail of the output around to report it if the build fails.
+    tail: typing.Deque[str] = collections.deque(maxlen=_BUILD_LOG_TAIL)
+    # Build output is not guaranteed to be valid UTF-8. Don't let a stray byte kill the build.
+    with subprocess.Popen(
+        cmd,
+        stdout=subprocess.PIPE,
+        stderr=subprocess.STDOUT,
+        text=True,
+        errors="replace",
+        bufsize=1,
+    ) as proc:
+        for line in proc.stdout:
+            line = line.rstrip("\n")
+            logger.debug("%s: %s", directory, line)
+            tail.append(line)
+            yield line
+    if proc.returncode != 0:
+        logger.error("Building packages in %s failed:\n%s", directory, "\n".join(tail))
+        raise subprocess.CalledProcessError(proc.returncode, cmd)
+
+
+def get_package_from_stdout(lines: typing.Iterable[str]) -> typing.Iterable[str]:
+    for line in lines:
+        if line.startswith(_PKG_PREFIX):
+            pkg_file = line[_PKG_PREFIX_LEN:]
             logger.info(f"Succesfully built package {pkg_file}")
             yield pkg_file
 
 
-def update_packages(cfg: Configuration, packages: typing.List[pathlib.Path]) -> None:
-    ssh_ops = SSHOperations(cfg.ssh_config)
-    for machine in cfg.machines:
-        logger.info(f"Updating packages on {machine}")
-        to_install = []
-        for pkg in packages:
-            name = pkg.name.split("_", 1)[0]
-            logger.info(f"Checking if {name} has to be installed:")
-            if cfg.skip_check or is_package_installed(ssh_ops, machine, name):
-                logger.info(f"Package is installed. Updating!")
-                copy_package(ssh_ops, machine, pkg)
-                to_install.append(pkg.name)
-            else:
-                logger.info("Skipped!")
-        install_packages(ssh_ops, machine, to_install)
-
-
-@dataclasses.dataclass(frozen=True)
+def update_packages(cfg: Configuration) -> None:
+    """Build the packages and update them on all machines.
+
+    Every machine gets its own queue which is fed with the packages while the builds are still
+    running, so uploading the packages overlaps with building the remaining ones. The packages are
+    only installed once all builds succeeded.
+
+    """
+    queues: typing.Dict[str, queue.Queue] = {
+        machine: queue.Queue() for machine in cfg.machines
+    }
+
+    def publish(pkg_path: pathlib.Path) -> None:
+        for packages_queue in queues.values():
+            packages_queue.put(pkg_path)
+
+    with SSHOperations(cfg.ssh_config) as ssh_ops:
+        # The machines are independent of each other and the work is waiting for ssh, so
+        # update them concurrently.
+        max_workers = min(len(cfg.machines), 16)
+        with concurrent.futures.ThreadPoolExecutor(max_workers=max_workers) as executor:
+            futures = []
+            for machine in cfg.machines:
+                future = executor.submit(
+                    _update_one_machine,
+                    ssh_ops,
+                    machine,
+                    queues[machine],
+                    cfg.skip_check,
+                )
+                # Report a failing machine right away, not only after all builds finished.
+                future.add_done_callback(functools.partial(_log_failure, machine))
+                futures.append(future)
+            try:
+                build_packages_and_get_paths(cfg, on_package=publish)
+            except BaseException:
+                for packages_queue in queues.values():
+                    packages_queue.put(_ABORT)
+                raise
+            for packages_queue in queues.values():
+                packages_queue.put(_DONE)
+            for future in futures:
+                future.result()
+
+
+def _log_failure(machine: str, future: concurrent.futures.Future) -> None:
+    if not future.cancelled() and future.exception() is not None:
+        logger.error(f"{machine}: Updating packages failed: {future.exception()}")
+
+
+# Sentinels to signal the end of the package queues.
+_DONE = object()
+_ABORT = object()
+
+# Upload at most this many packages at once ...
+_UPLOAD_BATCH_SIZE = 8
+# ... but don't wait longer than this many seconds for more packages to fill up the batch.
+_UPLOAD_IDLE_TIMEOUT = 1.0
+
+
+def _update_one_machine(
+    ssh_ops: "SSHOperations",
+    machine: str,
+    packages_queue: queue.Queue,
+    skip_check: bool,
+) -> None:
+    logger.info(f"Updating packages on {machine}")
+    packages: typing.List[pathlib.Path] = []
+    batch: typing.List[pathlib.Path] = []
+    while True:
+        try:
+            item = packages_queue.get(timeout=_UPLOAD_IDLE_TIMEOUT if batch else None)
+        except queue.Empty:
+            # Nothing arrived for a while, so upload what we have.
+            item = None
+        if item is _ABORT:
+            logger.warning(
+                f"{machine}: Could not get all packages. Not installing any packages!"
+            )
+            return
+        if isinstance(item, pathlib.Path):
+            batch.append(item)
+            if len(batch) < _UPLOAD_BATCH_SIZE:
+                continue
+        copy_packages(ssh_ops, machine, batch)
+        packages.extend(batch)
+        batch = []
+        if item is _DONE:
+            break
+    install_packages(ssh_ops, machine, packages, skip_check)
+
+
+@dataclasses.dataclass
 class SSHOperations:
-    ssh_config: typing.Optional[str]
+    """Run commands on remote machines.
+
+    All connections to the same machine are multiplexed over a single master connection (see
+    `ControlMaster' in ssh_config(5)). Use as a context manager or call `close' to tear the master
+    connections down again.
 
-    def scp(self, src: str, dest: str) -> subprocess.CompletedProcess:
-        cmd = self._add_ssh_config_if_needed(["scp"])
-        cmd.extend([src, dest])
+    """
+
+    ssh_config: typing.Optional[str]
+    # Keep the path short: the control socket path must fit into the 104 bytes of `sun_path', and
+    # a `$TMPDIR' like the one on macOS is already too long for that.
+    control_dir: str = dataclasses.field(
+        default_factory=functools.partial(tempfile.mkdtemp, prefix="up-", dir="/tmp"),
+        init=False,
+    )
+    _machines: typing.Set[str] = dataclasses.field(default_factory=set, init=False)
+
+    def __enter__(self) -> "SSHOperations":
+        return self
+
+    def __exit__(self, *exc_info) -> None:
+        self.close()
+
+    def close(self) -> None:
+        for machine in self._machines:
+            cmd = self._ssh_options([_SSH])
+            cmd.extend(["-O", "exit", machine])
+            logger.debug("Running %r", cmd)
+            subprocess.run(
+                cmd,
+                check=False,
+                stdin=subprocess.DEVNULL,
+                stdout=subprocess.DEVNULL,
+                stderr=subprocess.DEVNULL,
+            )
+        self._machines.clear()
+        shutil.rmtree(self.control_dir, ignore_errors=True)
+
+    def rsync_upload(self, machine: str, paths: typing.List[pathlib.Path]) -> None:
+        self._machines.add(machine)
+        ssh_cmd = self._ssh_options([_SSH])
+        cmd = [
+            _RSYNC,
+            "--archive",
+            "--no-relative",
+            "--rsh",
+            " ".join(shlex.quote(arg) for arg in ssh_cmd),
+            "--files-from=-",
+            "/",
+            f"{machine}:",
+        ]
         logger.debug("Running %r", cmd)
-        return subprocess.run(cmd, check=True)
+        subprocess.run(
+            cmd,
+            input="\n".join(str(path.absolute()) for path in paths),
+            text=True,
+            check=True,
+        )
 
-    def ssh(
-        self, machine: str, remote_cmd: str, *args, **kwargs
-    ) -> subprocess.CompletedProcess:
-        cmd = self._add_ssh_config_if_needed(["ssh"])
+    def ssh_lines(self, machine: str, remote_cmd: str) -> typing.Iterator[str]:
+        """Run `remote_cmd' on `machine' and yield its output line by line as it arrives."""
+        self._machines.add(machine)
+        cmd = self._ssh_options([_SSH])
         cmd.extend([machine, remote_cmd])
         logger.debug("Running %r", cmd)
-        return subprocess.run(cmd, *args, **kwargs)
-
-    def _add_ssh_config_if_needed(self, cmd):
+        # Several of these run concurrently, so don't let them read from our terminal.
+        with subprocess.Popen(
+            cmd,
+            stdin=subprocess.DEVNULL,
+            stdout=subprocess.PIPE,
+            stderr=subprocess.STDOUT,
+            text=True,
+            errors="replace",
+            bufsize=1,
+        ) as proc:
+            for line in proc.stdout:
+                yield line.rstrip("\n")
+        if proc.returncode != 0:
+            raise subprocess.CalledProcessError(proc.returncode, cmd)
+
+    def _ssh_options(self, cmd):
         if self.ssh_config is not None:
             cmd.extend(["-F", self.ssh_config])
+        cmd.extend(
+            [
+                "-o",
+                "ControlMaster=auto",
+                "-o",
+                f"ControlPath={self.control_dir}/cm-%C",
+                "-o",
+                "ControlPersist=60s",
+            ]
+        )
         return cmd
 
 
-def copy_package(ssh_ops: SSHOperations, machine: str, pkg_path: pathlib.Path) -> None:
-    logger.debug("Copying over the package")
-    ssh_ops.scp(str(pkg_path), f"{machine}:{pkg_path.name}")
+def copy_packages(
+    ssh_ops: SSHOperations, machine: str, pkg_paths: typing.List[pathlib.Path]
+) -> None:
+    if pkg_paths == []:
+        return
+
+    logger.debug("Copying over the packages")
+    ssh_ops.rsync_upload(machine, pkg_paths)
 
 
 def install_packages(
-    ssh_ops: SSHOperations, machine: str, pkg_paths: typing.List[str]
+    ssh_ops: SSHOperations,
+    machine: str,
+    pkg_paths: typing.List[pathlib.Path],
+    skip_check: bool,
 ) -> None:
     if pkg_paths == []:
         logger.info("No packages to install!")
         return
 
     logger.debug("Running dpkg-install")
-    pkgs = " ".join(pkg_path for pkg_path in pkg_paths)
-    ssh_ops.ssh(machine, f"dpkg --install {pkgs}", check=True)
+    script = _install_script(pkg_paths, skip_check)
+    logger.debug("Install script is:\n%s", script)
+    for line in ssh_ops.ssh_lines(machine, script):
+        logger.info(f"{machine}: {line}")
 
 
-def is_package_installed(ssh_ops: SSHOperations, machine: str, package: str) -> bool:
-    result = ssh_ops.ssh(
-        machine,
-        f"dpkg-query --status {package}",
-        check=False,
-        stdout=subprocess.DEVNULL,
-        stderr=subprocess.PIPE,
+def _install_script(pkg_paths: typing.List[pathlib.Path], skip_check: bool) -> str:
+    """Build a shell script which updates the packages in a single ssh call.
+
+    Unless `skip_check' is set, only the packages already installed on the machine are passed on
+    to dpkg. The packages to install are collected in the positional parameters of the script.
+
+    """
+    if skip_check:
+        return "dpkg --install " + " ".join(
+            shlex.quote(pkg_path.name) for pkg_path in pkg_paths
+        )
+
+    lines = ["set -e", "set --"]
+    for pkg_path in pkg_paths:
+        name = pkg_path.name.split("_", 1)[0]
+        add_pkg = f'set -- "$@" {shlex.quote(pkg_path.name)}'
+        status = (
+            "dpkg-query --show --showformat='${db:Status-Status}' "
+            f"{shlex.quote(name)}"
+        )
+        # dpkg-query exits with 1 if the package is unknown, anything higher is a real error.
+        # Packages which are e.g. half-configured count as installed, as they are the ones most
+        # in need of an update. Only packages not (or no longer) installed are skipped.
+        lines.extend(
+            [
+                "rc=0",
+                f"status=$({status}) || rc=$?",
+                'if [ "$rc" -gt 1 ]; then exit "$rc"; fi',
+                'case "$status" in',
+                '    ""|not-installed|config-files)',
+                f"        echo {shlex.quote(f'Skipped {name}!')}",
+                "        ;;",
+                "    *)",
+                f"        echo {shlex.quote(f'Package {name} is installed. Updating!')}",
+                f"        {add_pkg}",
+                "        ;;",
+                "esac",
+            ]
+        )
+    lines.extend(
+        [
+            'if [ "$#" -gt 0 ]; then',
+            '    dpkg --install "$@"',
+            "else",
+            "    echo 'No packages to install!'",
+            "fi",
+        ]
     )
-    if result.returncode > 1:
-        result.check_returncode()
-    return result.returncode == 0
+    return "\n".join(lines)
 
 
 if __name__ == "__main__":
-    args = PARSER.parse_args()
+    args = make_arg_parser().parse_args()
     logger.addHandler(logging.StreamHandler(stream=sys.stdout))
     logger.setLevel(args.log_level)
     main(args)